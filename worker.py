@@ -1,16 +1,26 @@
 import os
-import json
+import re
+import asyncio
 import time
 import hmac
 import hashlib
 import logging
-from typing import Any, Dict, Optional
+import functools
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
 
 import httpx
-from fastapi import FastAPI, Request, Header, HTTPException
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Header, HTTPException, Response, Depends
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-from telegram import Update
+from telegram import Message, Update
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes
 
 
@@ -21,49 +31,16 @@ logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
 )
+# httpx/httpcore на INFO пишут полный URL запроса, а у Telegram это
+# https://api.telegram.org/bot<TOKEN>/... — не даём токену попасть в лог вообще
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
 log = logging.getLogger("summary_bot")
 
-APP_VERSION = os.getenv("APP_VERSION", "v16")  # можно менять для проверки, что релиз обновился
-
-
-# ============================
-# ENV (Telegram / Webhook)
-# ============================
-BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")
-WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
-
-# Флаг: отправлять summary обратно в SMAIPL (push) или нет
-SEND_TO_SMAIPL = os.getenv("SEND_TO_SMAIPL", "false").strip().lower() in ("1", "true", "yes", "y", "on")
 
 # ============================
-# ENV (SMAIPL LLM – chat completions)
-# ============================
-# У тебя это работает по Bearer token:
-#   POST https://ai.smaipl.ru/v1/chat/completions
-#   Authorization: Bearer <SMAIPL_API_KEY>
-SMAIPL_BASE_URL = os.getenv("SMAIPL_BASE_URL", "https://ai.smaipl.ru/v1").strip().rstrip("/")
-SMAIPL_API_KEY = os.getenv("SMAIPL_API_KEY", "").strip()  # Bearer token
-SMAIPL_MODEL = os.getenv("SMAIPL_MODEL", "gpt-4o-mini").strip()
-
-# ============================
-# ENV (SMAIPL legacy ask – optional push)
-# ============================
-# Это тот endpoint, который у тебя возвращал {"error": true}.
-# Оставляем опционально, чтобы была функция send_summary_to_smaipl()
-SMAIPL_API_URL = os.getenv("SMAIPL_API_URL", "").strip()  # полный URL на /api/v1.0/ask/<token>
-SMAIPL_BOT_ID = os.getenv("SMAIPL_BOT_ID", "").strip()    # например 5129
-SMAIPL_CHAT_ID = os.getenv("SMAIPL_CHAT_ID", "").strip()  # например ask123456
-SMAIPL_RESPONSE_FIELD = os.getenv("SMAIPL_RESPONSE_FIELD", "done").strip()
-
+# Config (ENV читаем один раз при импорте)
 # ============================
-# ENV (Auth for /api/summary)
-# ============================
-# Чтобы SMAIPL мог безопасно дергать наш API, используем тот же WEBHOOK_SECRET:
-# SMAIPL будет отправлять заголовок: X-Api-Key: <WEBHOOK_SECRET>
-API_KEY_HEADER = os.getenv("API_KEY_HEADER", "X-Api-Key").strip()
-
-
 def _mask(s: str, keep: int = 4) -> str:
     if not s:
         return ""
@@ -72,18 +49,173 @@ def _mask(s: str, keep: int = 4) -> str:
     return s[:keep] + "*" * (len(s) - keep)
 
 
+def _env_str(name: str, default: str = "") -> str:
+    return os.environ.get(name, default).strip()
+
+
 def _env_bool(name: str, default: bool = False) -> bool:
-    v = os.getenv(name, str(default)).strip().lower()
+    v = _env_str(name, str(default)).lower()
     return v in ("1", "true", "yes", "y", "on")
 
 
+@dataclass(frozen=True, slots=True)
+class Config:
+    app_version: str  # можно менять для проверки, что релиз обновился
+
+    # --- Telegram / Webhook ---
+    bot_token: str
+    public_base_url: str
+    webhook_secret: str
+    send_to_smaipl: bool  # отправлять summary обратно в SMAIPL (push) или нет
+    # webhook (по умолчанию, Fly/Railway) | polling (локально / без публичного URL; только WEB_CONCURRENCY=1,
+    # проверяется в _load_env)
+    bot_mode: str
+    # команда суммаризации в Telegram, например /summary или /tldr; хранится без "/", проверена в _load_env
+    summary_command: str
+    # воркеры очереди webhook-апдейтов (в polling — лимит параллельных апдейтов PTB); каждый держит апдейт
+    # до конца обработки (с /summary — до SMAIPL_TIMEOUT), поэтому их должно быть больше
+    # MAX_CONCURRENT_SUMMARIES, иначе /start ждёт за медленными /summary
+    update_workers: int
+    # сколько (сек) на shutdown дорабатывать уже принятые апдейты; должно быть меньше kill_timeout
+    # платформы (fly.toml), иначе процесс убьют до закрытия tg_app и httpx-клиента
+    shutdown_drain_timeout: float
+
+    # --- SMAIPL LLM – chat completions ---
+    # У тебя это работает по Bearer token:
+    #   POST https://ai.smaipl.ru/v1/chat/completions
+    #   Authorization: Bearer <SMAIPL_API_KEY>
+    smaipl_base_url: str
+    smaipl_api_key: str  # Bearer token
+    smaipl_model: str
+    # SSE-стриминг ответа (OpenAI-совместимый "stream": true); если сервер отвечает обычным JSON — тоже ок
+    smaipl_stream: bool
+    # как часто (сек) обновлять сообщение в Telegram частичным ответом во время стрима;
+    # чаще не стоит — в группах Telegram режет edit'ы flood-лимитом
+    stream_edit_interval: float
+    smaipl_timeout: float  # сек, общий для chat completions и legacy ask
+    # бюджет входного текста в символах (~3000 токенов): латентность/стоимость LLM растут с длиной промпта
+    ctx_char_budget: int
+    # сколько запросов к SMAIPL может идти одновременно (остальные ждут очереди) — на всю машину:
+    # делится поровну между WEB_CONCURRENCY процессами, в каждом минимум 1
+    max_concurrent_summaries: int
+    # кол-во процессов uvicorn (тот же WEB_CONCURRENCY, что читает uvicorn CLI)
+    web_concurrency: int
+    # exact-match кэш готовых summary (сек / кол-во записей)
+    summary_cache_ttl: float
+    summary_cache_size: int
+
+    # --- SMAIPL legacy ask – optional push ---
+    # Это тот endpoint, который у тебя возвращал {"error": true}.
+    # Оставляем опционально, чтобы была функция send_summary_to_smaipl()
+    smaipl_api_url: str  # полный URL на /api/v1.0/ask/<token>
+    smaipl_bot_id: str  # например 5129
+    smaipl_chat_id: str  # например ask123456
+    smaipl_response_field: str
+
+    # --- Auth for /api/summary ---
+    # Чтобы SMAIPL мог безопасно дергать наш API, используем тот же WEBHOOK_SECRET:
+    # SMAIPL будет отправлять заголовок: X-Api-Key: <WEBHOOK_SECRET>
+    api_key_header: str
+
+
+BOT_MODES = ("webhook", "polling")
+# что примет CommandHandler PTB (и Telegram в меню команд): строчные латиница, цифры, "_", до 32 символов
+_COMMAND_RE = re.compile(r"[a-z0-9_]{1,32}")
+# хвост обрезанного текста (_clip_source_text); здесь — чтобы _load_env проверил, что бюджет его вмещает
+_TRUNCATED_MARKER = "\n[… текст обрезан, дальше не показан …]"
+
+
+def _load_env() -> Dict[str, Any]:
+    env = {
+        "app_version": _env_str("APP_VERSION", "v16"),
+        "bot_token": _env_str("BOT_TOKEN"),
+        "public_base_url": _env_str("PUBLIC_BASE_URL").rstrip("/"),
+        "webhook_secret": _env_str("WEBHOOK_SECRET"),
+        "send_to_smaipl": _env_bool("SEND_TO_SMAIPL", False),
+        "bot_mode": _env_str("BOT_MODE", "webhook").lower(),
+        "summary_command": _env_str("SUMMARY_COMMAND", "/summary"),
+        "update_workers": int(_env_str("UPDATE_WORKERS", "16")),
+        "shutdown_drain_timeout": float(_env_str("SHUTDOWN_DRAIN_TIMEOUT", "20")),
+        "smaipl_base_url": _env_str("SMAIPL_BASE_URL", "https://ai.smaipl.ru/v1").rstrip("/"),
+        "smaipl_api_key": _env_str("SMAIPL_API_KEY"),
+        "smaipl_model": _env_str("SMAIPL_MODEL", "gpt-4o-mini"),
+        "smaipl_stream": _env_bool("SMAIPL_STREAM", True),
+        "stream_edit_interval": float(_env_str("STREAM_EDIT_INTERVAL", "1.0")),
+        "smaipl_timeout": float(_env_str("SMAIPL_TIMEOUT", "60")),
+        "ctx_char_budget": int(_env_str("CTX_CHAR_BUDGET", "12000")),
+        "max_concurrent_summaries": int(_env_str("MAX_CONCURRENT_SUMMARIES", "8")),
+        "web_concurrency": max(1, int(_env_str("WEB_CONCURRENCY", "1"))),
+        "summary_cache_ttl": float(_env_str("SUMMARY_CACHE_TTL", "300")),
+        "summary_cache_size": int(_env_str("SUMMARY_CACHE_SIZE", "1024")),
+        "smaipl_api_url": _env_str("SMAIPL_API_URL"),
+        "smaipl_bot_id": _env_str("SMAIPL_BOT_ID"),
+        "smaipl_chat_id": _env_str("SMAIPL_CHAT_ID"),
+        "smaipl_response_field": _env_str("SMAIPL_RESPONSE_FIELD", "done"),
+        "api_key_header": _env_str("API_KEY_HEADER", "X-Api-Key"),
+    }
+
+    # ошибки конфига — сразу при импорте, с понятным текстом, а не странным поведением потом
+    # "/summary" -> "summary"; пустое SUMMARY_COMMAND -> "summary"
+    env["summary_command"] = env["summary_command"].removeprefix("/") or "summary"
+    if not _COMMAND_RE.fullmatch(env["summary_command"]):
+        raise RuntimeError(
+            f"SUMMARY_COMMAND must match /[a-z0-9_]{{1,32}}, got {env['summary_command']!r}"
+        )
+    if env["bot_mode"] not in BOT_MODES:
+        raise RuntimeError(f"BOT_MODE must be one of {', '.join(BOT_MODES)}, got {env['bot_mode']!r}")
+    if env["bot_mode"] == "polling" and env["web_concurrency"] > 1:
+        # N процессов = N циклов getUpdates: Telegram отвечает 409 Conflict, апдейты делятся случайно
+        raise RuntimeError("BOT_MODE=polling requires WEB_CONCURRENCY=1")
+    if env["ctx_char_budget"] <= len(_TRUNCATED_MARKER):
+        # иначе срез в _clip_source_text уходит в минус и режет текст где попало
+        raise RuntimeError(f"CTX_CHAR_BUDGET must be greater than {len(_TRUNCATED_MARKER)}")
+    return env
+
+
+CFG = Config(**_load_env())
+
+
 # ============================
 # FastAPI app (Fly expects `app`)
 # ============================
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # on_startup / on_shutdown — ниже, в разделе Startup / Shutdown
+    await on_startup()
+    try:
+        yield
+    finally:
+        await on_shutdown()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# заметный выигрыш только на длинных summary из /api/summary; ack/health меньше порога и идут как есть
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+# Telegram PTB app: живёт в app.state.tg_app (None, если BOT_TOKEN не задан —
+# тогда /api/summary продолжает работать без Telegram)
+app.state.tg_app = None
+app.state.bot = None  # tg_app.bot, для Update.de_json в webhook
+# Очередь webhook-апдейтов и её воркеры: создаются в on_startup (только если Telegram поднят)
+app.state.update_queue = None
+app.state.update_workers = []
+
+# Общий httpx-клиент для SMAIPL (keep-alive пул): создаётся в on_startup, закрывается в on_shutdown (lifespan)
+app.state.smaipl_client = None
+
+# Ограничитель параллельных вызовов SMAIPL: пачка апдейтов от Telegram не должна
+# превращаться в такую же пачку одновременных запросов к LLM (квота / 429).
+# Семафор у каждого процесса свой — делим общий лимит, чтобы N воркеров не дали N x MAX_CONCURRENT_SUMMARIES
+SMAIPL_CONCURRENCY = max(1, CFG.max_concurrent_summaries // CFG.web_concurrency)
+_smaipl_sem = asyncio.Semaphore(SMAIPL_CONCURRENCY)
 
-# Telegram PTB app
-tg_app: Optional[Application] = None
+# Кэш, single-flight ниже и _active_chats живут в памяти процесса: при WEB_CONCURRENCY > 1
+# дубль, попавший в другой воркер, их не увидит и пойдёт в SMAIPL сам.
+# Повторный /summary на тот же текст (дабл-клик, два пользователя наперегонки)
+# отдаём из памяти, без похода в SMAIPL. Фолбэк-резюме сюда не попадает.
+_summary_cache: TTLCache = TTLCache(maxsize=CFG.summary_cache_size, ttl=CFG.summary_cache_ttl)
+# Single-flight: ключ -> Future запроса, который уже идёт в SMAIPL; запись живёт только пока он в полёте
+_summary_inflight: "Dict[bytes, asyncio.Future[Optional[str]]]" = {}
 
 
 # ============================
@@ -100,42 +232,145 @@ class SummaryResponse(BaseModel):
     summary: str
     model: str
     provider: str = "smaipl_chat_completions"
-    version: str = APP_VERSION
+    version: str = CFG.app_version
+
+
+# ============================
+# SMAIPL: shared HTTP client
+# ============================
+def _build_smaipl_client() -> httpx.AsyncClient:
+    # один пул соединений на процесс: TCP+TLS до SMAIPL не поднимается заново на каждый /summary;
+    # HTTP/2 мультиплексирует параллельные запросы в одно соединение (если сервер не умеет h2 — будет h1.1)
+    return httpx.AsyncClient(
+        http2=True,
+        # SMAIPL_TIMEOUT — на чтение ответа LLM; недоступный хост должен отваливаться за секунды, а не за минуту
+        timeout=httpx.Timeout(CFG.smaipl_timeout, connect=5.0),
+        # keepalive_expiry 60s (в httpx по умолчанию 5s): соседние /summary не переподнимают TLS
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60.0),
+    )
+
+
+def _smaipl_client() -> httpx.AsyncClient:
+    client: Optional[httpx.AsyncClient] = app.state.smaipl_client
+    if client is None:
+        raise RuntimeError("SMAIPL client is not initialised")
+    return client
 
 
 # ============================
 # SMAIPL: chat completions (primary)
 # ============================
-async def smaipl_chat_completion(user_text: str, system_prompt: Optional[str] = None) -> str:
+# Всё, что зависит только от конфига, собираем один раз при импорте
+_CHAT_URL = f"{CFG.smaipl_base_url}/chat/completions"
+_CHAT_HEADERS = {"Authorization": f"Bearer {CFG.smaipl_api_key}", "Content-Type": "application/json"}
+_CHAT_PAYLOAD_BASE: Dict[str, Any] = {"model": CFG.smaipl_model}
+if CFG.smaipl_stream:
+    _CHAT_PAYLOAD_BASE["stream"] = True
+
+
+# колбэк для частичного ответа: получает весь накопленный на данный момент текст
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+
+async def smaipl_chat_completion(
+    user_text: str,
+    system_prompt: Optional[str] = None,
+    on_progress: Optional[ProgressCallback] = None,
+) -> str:
     """
     Основной рабочий путь (у тебя он уже отвечает):
     POST {SMAIPL_BASE_URL}/chat/completions
     Authorization: Bearer {SMAIPL_API_KEY}
+
+    on_progress (если передан) вызывается во время стрима не чаще STREAM_EDIT_INTERVAL.
     """
-    if not SMAIPL_API_KEY:
+    if not CFG.smaipl_api_key:
         raise RuntimeError("SMAIPL_API_KEY is not set")
 
-    url = f"{SMAIPL_BASE_URL}/chat/completions"
-
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": user_text})
 
-    payload = {"model": SMAIPL_MODEL, "messages": messages}
+    payload = {**_CHAT_PAYLOAD_BASE, "messages": messages}
 
-    headers = {"Authorization": f"Bearer {SMAIPL_API_KEY}", "Content-Type": "application/json"}
+    client = _smaipl_client()
+    if _smaipl_sem.locked():
+        # все MAX_CONCURRENT_SUMMARIES слотов заняты — запрос встаёт в очередь; в логе видно, что упёрлись в лимит
+        log.info("smaipl_queued max_concurrent=%d", SMAIPL_CONCURRENCY)
+    async with _smaipl_sem:
+        async with client.stream("POST", _CHAT_URL, headers=_CHAT_HEADERS, content=orjson.dumps(payload)) as r:
+            r.raise_for_status()
+            content_type = r.headers.get("content-type", "")
+            if "text/event-stream" in content_type:
+                content = await _read_sse_content(r, on_progress)
+            else:
+                await r.aread()
+                content = _plain_content(r, content_type)
+
+    # стрим без delta.content (error-кадр, только role), пустое тело: это сбой, а не summary —
+    # пусть уйдёт в фолбэк, а не в кэш и не в reply_text("")
+    content = content.strip()
+    if not content:
+        raise RuntimeError("SMAIPL returned an empty completion")
+    return content
+
+
+def _plain_content(r: httpx.Response, content_type: str) -> str:
+    # не JSON на chat completions — это не ответ модели (HTML прокси/captive portal и т.п.):
+    # в чат и в кэш его не отдаём, пусть уйдёт в фолбэк. Текст как есть принимает только legacy /ask
+    if "json" not in content_type:
+        raise RuntimeError(f"SMAIPL returned non-JSON response: {content_type or 'no content-type'}")
+    data = orjson.loads(r.content)
+
+    # ожидаем стандартный формат choices[0].message.content; без него (200 с {"error": ...},
+    # {"choices": []}, content: null) это сбой, а не summary — сырой JSON в чат и в кэш не отдаём
+    content = _choice_content(data, "message")
+    if content is None:
+        raise RuntimeError(f"SMAIPL response has no choices[0].message.content: {r.text[:200]!r}")
+    return content
+
+
+async def _read_sse_content(r: httpx.Response, on_progress: Optional[ProgressCallback] = None) -> str:
+    """
+    Собирает choices[0].delta.content из SSE-кадров вида "data: {...}".
+    Остальные поля (usage, logprobs и т.п.) не накапливаем.
+    """
+    parts = []
+    next_progress = time.monotonic() + CFG.stream_edit_interval
+    async for line in r.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        chunk = line[6:]
+        if chunk == "[DONE]":
+            break
+        try:
+            frame = orjson.loads(chunk)
+        except ValueError:
+            continue
+        content = _choice_content(frame, "delta")
+        if content:
+            parts.append(content)
+            if on_progress is not None and time.monotonic() >= next_progress:
+                await on_progress("".join(parts))
+                next_progress = time.monotonic() + CFG.stream_edit_interval
+    return "".join(parts)
+
+
+def _choice_content(data: Any, key: str) -> Optional[str]:
+    """
+    choices[0][key].content из OpenAI-совместимого ответа:
+    key="message" для обычного ответа, key="delta" для SSE-кадра.
+    """
+    try:
+        content = data["choices"][0][key]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return content if isinstance(content, str) else None
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        r = await client.post(url, headers=headers, json=payload)
-        r.raise_for_status()
-        data = r.json()
 
-    # ожидаем стандартный формат choices[0].message.content
-    try:
-        return str(data["choices"][0]["message"]["content"])
-    except Exception:
-        return json.dumps(data, ensure_ascii=False)
+# одна таблица на все вызовы: переводы строк/табы -> пробел за один проход
+_NEWLINE_TO_SPACE = str.maketrans("\n\r\t", "   ")
 
 
 def naive_fallback_summary(text: str) -> str:
@@ -149,49 +384,162 @@ def naive_fallback_summary(text: str) -> str:
     # обрежем, разобьём на предложения
     cut = text[:2000]
     # грубая эвристика: первые 3-5 "предложений"
-    parts = [p.strip() for p in cut.replace("\n", " ").split(".") if p.strip()]
+    parts = [p.strip() for p in cut.translate(_NEWLINE_TO_SPACE).split(".") if p.strip()]
     head = parts[:5]
     bullets = "\n".join([f"- {p}." for p in head]) if head else cut
     return "Фолбэк-резюме (LLM недоступна):\n" + bullets
 
 
-async def generate_summary_with_retry(source_text: str, *, language: str = "ru") -> str:
+async def generate_summary_with_retry(
+    source_text: str,
+    *,
+    language: str = "ru",
+    on_progress: Optional[ProgressCallback] = None,
+) -> str:
     """
     Retry + fallback:
-    1) 3 попытки вызвать SMAIPL chat completions
+    1) до 3 попыток вызвать SMAIPL chat completions (только на сетевых ошибках / 5xx / 429,
+       backoff 0.5s -> 1s)
     2) если не вышло — naive_fallback_summary()
+
+    Текст обрезается до CTX_CHAR_BUDGET ещё до запроса — платить токенами за то,
+    что всё равно не влезет в ответ, незачем.
+    Успешный ответ кладётся в _summary_cache (ключ: модель + язык + текст).
+    on_progress получает частичный ответ во время стрима (на попадании в кэш не вызывается).
     """
-    system_prompt = (
-        "Ты — аналитик по проектным коммуникациям. "
-        "Сделай краткое, структурированное резюме по пунктам. "
-        "Выдели ключевые решения/действия (если есть). "
-        f"Язык ответа: {language}."
-    )
+    source_text = _clip_source_text(source_text)
+
+    cache_key = _summary_cache_key(source_text, language)
+    cached = _summary_cache.get(cache_key)
+    if cached is not None:
+        return cached  # попадание в кэш — без блокировок
+
+    # Промах: если такой же запрос уже в полёте (ретраи Telegram, дабл-клик) — ждём его результат,
+    # а не шлём в SMAIPL второй такой же. shield: отмена ждущего не должна отменять чужой запрос.
+    inflight = _summary_inflight.get(cache_key)
+    if inflight is not None:
+        summary = await asyncio.shield(inflight)
+    else:
+        fut: "asyncio.Future[Optional[str]]" = asyncio.get_running_loop().create_future()
+        _summary_inflight[cache_key] = fut
+        summary = None
+        try:
+            summary = await _smaipl_summary_with_retry(source_text, language, on_progress)
+            if summary:
+                _summary_cache[cache_key] = summary
+        finally:
+            # и при отмене тоже: ждущие получат None и уйдут в фолбэк, а не повиснут
+            _summary_inflight.pop(cache_key, None)
+            fut.set_result(summary)
+
+    if summary is None:
+        return naive_fallback_summary(source_text)
+    return summary
+
+
+_SYSTEM_PROMPT = (
+    "Ты — аналитик по проектным коммуникациям. "
+    "Сделай краткое, структурированное резюме по пунктам. "
+    "Выдели ключевые решения/действия (если есть). "
+    "Язык ответа: {language}."
+)
 
+
+@functools.lru_cache(maxsize=32)
+def _system_prompt(language: str) -> str:
+    # языков единицы — промпт под каждый собирается один раз
+    return _SYSTEM_PROMPT.format(language=language)
+
+
+SMAIPL_ATTEMPTS = 3
+
+
+async def _smaipl_summary_with_retry(
+    source_text: str,
+    language: str,
+    on_progress: Optional[ProgressCallback] = None,
+) -> Optional[str]:
+    system_prompt = _system_prompt(language)
     user_text = f"ТЕКСТ:\n{source_text}"
 
     last_err: Optional[Exception] = None
-    for attempt in range(1, 4):
+    for attempt in range(1, SMAIPL_ATTEMPTS + 1):
         try:
-            return await smaipl_chat_completion(user_text=user_text, system_prompt=system_prompt)
+            return await smaipl_chat_completion(
+                user_text=user_text,
+                system_prompt=system_prompt,
+                on_progress=on_progress,
+            )
         except Exception as e:
             last_err = e
-            wait = 1.5 * attempt
-            log.warning(f"SMAIPL attempt {attempt}/3 failed: {e}. Retrying in {wait:.1f}s")
+            if not _is_retryable(e) or attempt == SMAIPL_ATTEMPTS:
+                break
+            wait = 0.5 * 2 ** (attempt - 1)
+            log.warning("smaipl_attempt_failed attempt=%d/%d retry_in=%.1fs error=%r", attempt, SMAIPL_ATTEMPTS, wait, e)
             await _sleep(wait)
 
-    log.error(f"SMAIPL failed after retries: {last_err}")
-    return naive_fallback_summary(source_text)
+    log.error("smaipl_failed attempts=%d error=%r", attempt, last_err)
+    return None
+
+
+def _is_retryable(e: Exception) -> bool:
+    # повторяем только то, что может пройти со второй попытки: сеть/таймауты, 5xx и 429;
+    # 401/400 и "SMAIPL_API_KEY is not set" повторять бессмысленно — сразу в фолбэк
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, httpx.TransportError)
+
+
+
+def _clip_source_text(text: str) -> str:
+    # одно сообщение, не история: начало важнее хвоста; маркер — чтобы LLM не приняла обрыв за конец текста
+    if len(text) <= CFG.ctx_char_budget:
+        return text
+    return text[:CFG.ctx_char_budget - len(_TRUNCATED_MARKER)] + _TRUNCATED_MARKER
+
+
+def _summary_cache_key(source_text: str, language: str) -> bytes:
+    # blake2b/16 байт: быстрее sha256 + hexdigest, коллизии для кэша на ~1000 записей не реальны
+    return hashlib.blake2b(
+        f"{CFG.smaipl_model}\0{language}\0{source_text}".encode("utf-8"),
+        digest_size=16,
+    ).digest()
 
 
 async def _sleep(seconds: float) -> None:
     # отдельная функция, чтобы было проще мокать/отлаживать
-    await __import__("asyncio").sleep(seconds)
+    await asyncio.sleep(seconds)
 
 
 # ============================
 # SMAIPL legacy push (optional)
 # ============================
+_MISSING = object()
+_LEGACY_HEADERS = {"Content-Type": "application/json"}
+
+
+def _legacy_config_error() -> Optional[str]:
+    # legacy-настройки не меняются — проверяем один раз; причину send_summary_to_smaipl() вернёт как есть
+    if not CFG.smaipl_api_url:
+        return "SMAIPL_API_URL not set"
+    if not CFG.smaipl_bot_id or not CFG.smaipl_chat_id:
+        return "SMAIPL_BOT_ID/SMAIPL_CHAT_ID not set"
+    try:
+        int(CFG.smaipl_bot_id)
+    except ValueError:
+        return "SMAIPL_BOT_ID must be integer"
+    return None
+
+
+_LEGACY_CONFIG_ERROR = _legacy_config_error()
+# bot_id/chat_id одни и те же на каждый push — приводим один раз; None, если конфиг неполный
+_LEGACY_PAYLOAD_BASE: Optional[Dict[str, Any]] = (
+    None
+    if _LEGACY_CONFIG_ERROR
+    else {"bot_id": int(CFG.smaipl_bot_id), "chat_id": CFG.smaipl_chat_id}
+)
+
+
 async def send_summary_to_smaipl(summary_text: str) -> Dict[str, Any]:
     """
     Best-effort PUSH результата в SMAIPL через legacy endpoint:
@@ -203,111 +551,254 @@ async def send_summary_to_smaipl(summary_text: str) -> Dict[str, Any]:
       - функция не ломает основной поток
       - ошибки логируются
     """
-    if not SMAIPL_API_URL:
-        return {"ok": False, "reason": "SMAIPL_API_URL not set"}
+    if _LEGACY_PAYLOAD_BASE is None:
+        return {"ok": False, "reason": _LEGACY_CONFIG_ERROR}
 
-    if not SMAIPL_BOT_ID or not SMAIPL_CHAT_ID:
-        return {"ok": False, "reason": "SMAIPL_BOT_ID/SMAIPL_CHAT_ID not set"}
+    payload = {**_LEGACY_PAYLOAD_BASE, "message": summary_text}
 
     try:
-        bot_id_int = int(SMAIPL_BOT_ID)
-    except ValueError:
-        return {"ok": False, "reason": "SMAIPL_BOT_ID must be integer"}
-
-    payload = {"bot_id": bot_id_int, "chat_id": SMAIPL_CHAT_ID, "message": summary_text}
+        r = await _smaipl_client().post(
+            CFG.smaipl_api_url,
+            content=orjson.dumps(payload),
+            headers=_LEGACY_HEADERS,
+        )
+        r.raise_for_status()
+        if "json" not in r.headers.get("content-type", ""):
+            return {"ok": True, "response": r.text.strip()}
+        data = orjson.loads(r.content)
 
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post(SMAIPL_API_URL, json=payload)
-            r.raise_for_status()
-            data = r.json()
+        if not isinstance(data, dict):
+            return {"ok": True, "response": data}
 
-        if isinstance(data, dict) and data.get("error") is True:
+        if data.get("error") is True:
             return {"ok": False, "reason": "SMAIPL returned error=true", "response": data}
 
-        # если вернули ожидаемое поле
-        if isinstance(data, dict) and SMAIPL_RESPONSE_FIELD in data:
-            return {"ok": True, "response": data, "value": data.get(SMAIPL_RESPONSE_FIELD)}
+        # если вернули ожидаемое поле (один lookup вместо `in` + get)
+        value = data.get(CFG.smaipl_response_field, _MISSING)
+        if value is not _MISSING:
+            return {"ok": True, "response": data, "value": value}
 
         return {"ok": True, "response": data}
+    except httpx.TimeoutException as e:
+        # самый частый сбой legacy /ask: трейсбек тут ничего не добавляет
+        log.warning("send_summary_to_smaipl timeout: %r", e)
+        return {"ok": False, "reason": "timeout"}
     except Exception as e:
-        log.exception("send_summary_to_smaipl failed")
+        log.error("send_summary_to_smaipl failed: %r", e, exc_info=True)
         return {"ok": False, "reason": str(e)}
 
 
 # ============================
 # Telegram handlers
 # ============================
+TG_MESSAGE_LIMIT = 4096
+# имя команды без "/" — уже нормализовано и проверено в _load_env
+SUMMARY_CMD_NAME = CFG.summary_command
+
+# Тексты бота не меняются — собираем один раз
+_START_TEXT = (
+    "Привет! Я Summary Bot.\n\n"
+    f"Команда: /{SUMMARY_CMD_NAME} — отправляй ответом (reply) на сообщение, которое нужно суммаризировать."
+)
+_SUMMARY_USAGE_TEXT = f"Команду /{SUMMARY_CMD_NAME} нужно отправлять ответом (reply) на сообщение для суммаризации."
+_SUMMARY_EMPTY_TEXT = "Не вижу текста для суммаризации (reply-сообщение пустое)."
+_SUMMARY_CLIPPED_NOTE = f"\n\n(текст длиннее {CFG.ctx_char_budget} символов — суммаризировано только начало)"
+_SUMMARY_BUSY_TEXT = "⏳ Уже готовлю summary, подождите."
+
+# Чаты, где /summary уже в работе: повторный клик не плодит ещё один запрос к SMAIPL.
+# Внутри одного воркера; при WEB_CONCURRENCY > 1 у каждого процесса свой набор.
+_active_chats: "set[int]" = set()
+
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.effective_message.reply_text(
-        "Привет! Я Summary Bot.\n\n"
-        "Команда: /summary — отправляй ответом (reply) на сообщение, которое нужно суммаризировать."
+    msg = update.effective_message
+    # без reply Telegram сам тему форума не подставит: /start в топике иначе ответит в General
+    await context.bot.send_message(
+        chat_id=msg.chat_id,
+        text=_START_TEXT,
+        message_thread_id=msg.message_thread_id if msg.is_topic_message else None,
     )
 
 
 async def summary_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     msg = update.effective_message
 
-    if not msg.reply_to_message or not msg.reply_to_message.text:
-        await msg.reply_text("Команду /summary нужно отправлять ответом (reply) на сообщение для суммаризации.")
+    if not msg.reply_to_message:
+        await msg.reply_text(_SUMMARY_USAGE_TEXT)
         return
 
-    source_text = (msg.reply_to_message.text or "").strip()
+    # фото/документ с подписью тоже суммаризируем; стикер/голос без текста — отвечаем сразу, без похода в SMAIPL
+    source_text = (msg.reply_to_message.text or msg.reply_to_message.caption or "").strip()
     if not source_text:
-        await msg.reply_text("Не вижу текста для суммаризации (reply-сообщение пустое).")
+        await msg.reply_text(_SUMMARY_EMPTY_TEXT)
         return
+    clipped = len(source_text) > CFG.ctx_char_budget
 
-    await msg.reply_text("Готовлю summary...")
+    chat_id = msg.chat_id
+    if chat_id in _active_chats:
+        await msg.reply_text(_SUMMARY_BUSY_TEXT)
+        return
+    _active_chats.add(chat_id)
+    try:
+        await _summarize_reply(context, msg, source_text, clipped)
+    finally:
+        _active_chats.discard(chat_id)
+
+
+async def _summarize_reply(
+    context: ContextTypes.DEFAULT_TYPE,
+    msg: Message,
+    source_text: str,
+    clipped: bool,
+) -> None:
+    # Вместо сообщения "Готовлю summary..." — typing: дешевле, Telegram сам его гасит, редактировать нечего.
+    # Ответ появляется с первым куском стрима и дальше редактируется; parse_mode=None — LLM-текст шлём как есть.
+    reply: Optional[Message] = None
+    shown = ""
+
+    async def show_progress(text: str) -> None:
+        nonlocal reply, shown
+        text = _fit_message(text)
+        if reply is None:
+            reply = await _send_reply(msg, text)
+            ok = reply is not None
+        else:
+            ok = await _edit_reply(reply, text)
+        if ok:
+            shown = text
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(_send_typing(context, msg.chat_id))
+        summary_task = tg.create_task(
+            generate_summary_with_retry(source_text, language="ru", on_progress=show_progress)
+        )
 
-    summary = await generate_summary_with_retry(source_text, language="ru")
-    await msg.reply_text(summary)
+    summary = summary_task.result()
+    text = _fit_message(summary, _SUMMARY_CLIPPED_NOTE if clipped else "")
+    if reply is None or (text != shown and not await _edit_reply(reply, text)):
+        await msg.reply_text(text, parse_mode=None)
 
     # опциональный push в SMAIPL legacy /ask
-    if SEND_TO_SMAIPL:
+    if CFG.send_to_smaipl:
         push_res = await send_summary_to_smaipl(summary)
-        log.info(f"SEND_TO_SMAIPL result: {push_res}")
+        log.info("SEND_TO_SMAIPL result: %s", push_res)
+
+
+def _fit_message(text: str, suffix: str = "") -> str:
+    # больше TG_MESSAGE_LIMIT Telegram не примет (BadRequest: Message is too long):
+    # режем сам текст, пометку в конце сохраняем
+    limit = TG_MESSAGE_LIMIT - len(suffix)
+    if len(text) > limit:
+        text = text[:limit - 1] + "…"
+    return text + suffix
+
+
+async def _send_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    # индикатор — косметика: его сбой не должен отменять генерацию summary в TaskGroup
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except TelegramError as e:
+        log.debug("send_chat_action failed: %r", e)
+
+
+async def _send_reply(msg: Message, text: str) -> Optional[Message]:
+    # частичный ответ из стрима: сбой Telegram не должен обрывать запрос к SMAIPL
+    try:
+        return await msg.reply_text(text, parse_mode=None)
+    except TelegramError as e:
+        log.debug("reply_text failed: %r", e)
+        return None
+
+
+async def _edit_reply(message: Message, text: str) -> bool:
+    # edit может не пройти (flood-лимит, "message is not modified", > 4096 символов) — это не повод ронять /summary
+    try:
+        await message.edit_text(text, parse_mode=None)
+        return True
+    except TelegramError as e:
+        log.debug("edit_text failed: %r", e)
+        return False
 
 
 def _build_tg_app() -> Application:
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(CFG.bot_token)
+    if CFG.bot_mode == "polling":
+        # по умолчанию PTB обрабатывает апдейты из polling строго по одному: один /summary
+        # держал бы все чаты до SMAIPL_TIMEOUT x попытки. Параллельно — столько же, сколько воркеров у webhook
+        builder = builder.concurrent_updates(CFG.update_workers)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_cmd))
-    application.add_handler(CommandHandler("summary", summary_cmd))
+    application.add_handler(CommandHandler(SUMMARY_CMD_NAME, summary_cmd))
     return application
 
 
+# ============================
+# Auth (WEBHOOK_SECRET)
+# ============================
+# Считаем один раз при импорте: на запрос остаётся одна проверка флага + compare_digest
+_SECRET_REQUIRED = bool(CFG.webhook_secret)
+_SECRET_BYTES = CFG.webhook_secret.encode()
+
+
+def _secret_matches(value: Optional[str]) -> bool:
+    return hmac.compare_digest((value or "").encode(), _SECRET_BYTES)
+
+
+def verify_secret(
+    x_api_key: Optional[str] = Header(default=None, alias=CFG.api_key_header),
+) -> None:
+    """
+    Depends() для /api/summary и /debug/config:
+    если WEBHOOK_SECRET задан, нужен заголовок X-Api-Key: <WEBHOOK_SECRET>
+    """
+    if _SECRET_REQUIRED and not _secret_matches(x_api_key):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
 # ============================
 # Health + Debug
 # ============================
-@app.get("/health")
-async def health() -> Dict[str, Any]:
-    return {"status": "ok", "version": APP_VERSION}
+# Ответы неизменны за всё время жизни процесса — собираем один раз (тело + заголовки),
+# health-check от Fly/Railway не должен каждый раз гонять dict -> JSON. Общие экземпляры
+# безопасны, пока никто не трогает их .headers (cookies/middleware, меняющие ответ, у нас нет)
+_HEALTH_RESPONSE = Response(
+    content=orjson.dumps({"status": "ok", "version": CFG.app_version}),
+    media_type="application/json",
+)
+_OK_RESPONSE = Response(content=orjson.dumps({"ok": True}), media_type="application/json")
 
 
-@app.get("/debug/config")
-async def debug_config(
-    x_api_key: Optional[str] = Header(default=None, alias=API_KEY_HEADER),
-) -> Dict[str, Any]:
-    # Защитим endpoint тем же WEBHOOK_SECRET (или отдельным ключом)
-    if WEBHOOK_SECRET:
-        if x_api_key != WEBHOOK_SECRET:
-            raise HTTPException(status_code=401, detail="Unauthorized")
+@app.get("/health")
+async def health() -> Response:
+    return _HEALTH_RESPONSE
 
+
+# Защитим endpoint тем же WEBHOOK_SECRET (или отдельным ключом)
+@app.get("/debug/config", dependencies=[Depends(verify_secret)])
+async def debug_config() -> Dict[str, Any]:
     return {
-        "version": APP_VERSION,
-        "public_base_url": PUBLIC_BASE_URL,
-        "send_to_smaipl": SEND_TO_SMAIPL,
+        "version": CFG.app_version,
+        "public_base_url": CFG.public_base_url,
+        "send_to_smaipl": CFG.send_to_smaipl,
+        "bot_mode": CFG.bot_mode,
+        "update_workers": CFG.update_workers,
         "telegram": {
-            "bot_token_set": bool(BOT_TOKEN),
-            "webhook_secret_set": bool(WEBHOOK_SECRET),
+            "bot_token_set": bool(CFG.bot_token),
+            "webhook_secret_set": bool(CFG.webhook_secret),
         },
         "smaipl": {
-            "base_url": SMAIPL_BASE_URL,
-            "model": SMAIPL_MODEL,
-            "api_key_set": bool(SMAIPL_API_KEY),
+            "base_url": CFG.smaipl_base_url,
+            "model": CFG.smaipl_model,
+            "stream": CFG.smaipl_stream,
+            "max_concurrent": CFG.max_concurrent_summaries,
+            "max_concurrent_per_worker": SMAIPL_CONCURRENCY,
+            "ctx_char_budget": CFG.ctx_char_budget,
+            "summary_cache": {"ttl": CFG.summary_cache_ttl, "size": len(_summary_cache)},
+            "api_key_set": bool(CFG.smaipl_api_key),
             "legacy_ask": {
-                "smaipl_api_url_set": bool(SMAIPL_API_URL),
-                "smaipl_bot_id_set": bool(SMAIPL_BOT_ID),
-                "smaipl_chat_id_set": bool(SMAIPL_CHAT_ID),
+                "smaipl_api_url_set": bool(CFG.smaipl_api_url),
+                "smaipl_bot_id_set": bool(CFG.smaipl_bot_id),
+                "smaipl_chat_id_set": bool(CFG.smaipl_chat_id),
             },
         },
     }
@@ -316,104 +807,201 @@ async def debug_config(
 # ============================
 # API endpoint for SMAIPL -> PilotBot (pull summary)
 # ============================
-@app.post("/api/summary", response_model=SummaryResponse)
-async def api_summary(
-    body: SummaryRequest,
-    x_api_key: Optional[str] = Header(default=None, alias=API_KEY_HEADER),
-) -> SummaryResponse:
+@app.post("/api/summary", response_model=SummaryResponse, dependencies=[Depends(verify_secret)])
+async def api_summary(body: SummaryRequest) -> SummaryResponse:
     """
     Это и есть правильный интеграционный endpoint:
     SMAIPL/плагин вызывает наш API и получает summary.
 
     Защита:
-      - если WEBHOOK_SECRET задан, то нужен заголовок X-Api-Key: <WEBHOOK_SECRET>
+      - если WEBHOOK_SECRET задан, то нужен заголовок X-Api-Key: <WEBHOOK_SECRET> (verify_secret)
     """
-    if WEBHOOK_SECRET:
-        if x_api_key != WEBHOOK_SECRET:
-            raise HTTPException(status_code=401, detail="Unauthorized")
-
     text = (body.text or "").strip()
     if not text:
         raise HTTPException(status_code=400, detail="text is required")
 
     # пользовательский prompt (если нужен)
     summary = await generate_summary_with_retry(text, language=body.language or "ru")
-    return SummaryResponse(ok=True, summary=summary, model=SMAIPL_MODEL)
+    return SummaryResponse(ok=True, summary=summary, model=CFG.smaipl_model)
 
 
 # ============================
 # Telegram webhook endpoint
 # ============================
-@app.post("/webhook/{secret}")
+# Апдейт от Telegram — единицы КБ; всё, что больше, считаем мусором
+MAX_WEBHOOK_BODY = 1024 * 1024
+
+# Сколько апдейтов может ждать свободного воркера; дальше — 429, Telegram повторит доставку сам
+UPDATE_QUEUE_SIZE = 1000
+
+
+# Постоянный путь без параметров: роутер сравнивает строку, а секрет Telegram
+# присылает в заголовке (setWebhook(secret_token=...)), а не в URL
+WEBHOOK_PATH = "/webhook"
+
+
+@app.post(WEBHOOK_PATH)
 async def telegram_webhook(
-    secret: str,
     request: Request,
     x_telegram_bot_api_secret_token: Optional[str] = Header(default=None),
-) -> Dict[str, Any]:
-    global tg_app
+) -> Response:
+    # 1) секрет в заголовке Telegram: без заголовка — тоже 403
+    if _SECRET_REQUIRED and not _secret_matches(x_telegram_bot_api_secret_token):
+        raise HTTPException(status_code=403, detail="Invalid secret token header")
 
-    if tg_app is None:
+    queue: "Optional[asyncio.Queue[Update]]" = request.app.state.update_queue
+    if queue is None:
         raise HTTPException(status_code=503, detail="Telegram app is not initialised")
 
-    # 1) секрет в URL
-    if WEBHOOK_SECRET and secret != WEBHOOK_SECRET:
-        raise HTTPException(status_code=403, detail="Invalid webhook secret")
+    # 2) размер тела: до чтения — по Content-Length, при чтении — по факту (chunked без Content-Length)
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if content_length > MAX_WEBHOOK_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    raw = await _read_webhook_body(request)
+
+    try:
+        data = orjson.loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    # Update от Telegram — всегда объект; [1,2] / null / "..." de_json не разберёт (500) или отдаст None
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Update must be a JSON object")
 
-    # 2) секрет в заголовке Telegram
-    if WEBHOOK_SECRET and x_telegram_bot_api_secret_token is not None:
-        if x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
-            raise HTTPException(status_code=403, detail="Invalid secret token header")
+    update = Update.de_json(data, request.app.state.bot)
 
-    data = await request.json()
-    update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
-    return {"ok": True}
+    # Отвечаем Telegram сразу: /summary может идти десятки секунд, а пока webhook не ответил,
+    # Telegram держит очередь апдейтов и шлёт повторы. Обработка — воркерами из очереди.
+    try:
+        queue.put_nowait(update)
+    except asyncio.QueueFull:
+        log.warning("update_queue_full size=%d update_id=%s", UPDATE_QUEUE_SIZE, update.update_id)
+        raise HTTPException(status_code=429, detail="Too many pending updates")
+    return _OK_RESPONSE
+
+
+async def _read_webhook_body(request: Request) -> bytes:
+    # читаем кусками и обрываем на пороге: в память не попадает больше MAX_WEBHOOK_BODY
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_WEBHOOK_BODY:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    return bytes(body)
+
+
+async def _update_worker(tg_app: Application, queue: "asyncio.Queue[Update]") -> None:
+    while True:
+        update = await queue.get()
+        try:
+            await tg_app.process_update(update)
+        except Exception:
+            log.exception("process_update failed")
+        finally:
+            queue.task_done()
 
 
 # ============================
 # Startup / Shutdown
 # ============================
-@app.on_event("startup")
 async def on_startup() -> None:
-    global tg_app
+    app.state.smaipl_client = _build_smaipl_client()
+    await _warmup_smaipl()
 
-    if not BOT_TOKEN:
+    if not CFG.bot_token:
         log.error("BOT_TOKEN is empty: Telegram app will not start.")
         return
 
     tg_app = _build_tg_app()
     await tg_app.initialize()
     await tg_app.start()
+    app.state.tg_app = tg_app
+    app.state.bot = tg_app.bot
+
+    if CFG.bot_mode == "polling":
+        # start_polling сам снимает webhook; /webhook в этом режиме просто не вызывается
+        await tg_app.updater.start_polling(drop_pending_updates=True)
+        log.info("Telegram polling started")
+        return
+
+    queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    app.state.update_workers = [
+        asyncio.create_task(_update_worker(tg_app, queue)) for _ in range(CFG.update_workers)
+    ]
+    app.state.update_queue = queue
+
+    await _set_webhook(tg_app)
+
+
+async def _warmup_smaipl() -> None:
+    # первый /summary после старта не должен платить за холодный TCP+TLS:
+    # лёгкий HEAD кладёт готовое соединение в keep-alive пул; ответ неважен
+    if not CFG.smaipl_api_key:
+        return
+    try:
+        await _smaipl_client().head(CFG.smaipl_base_url, timeout=5.0)
+    except httpx.HTTPError as e:
+        log.info("SMAIPL warmup failed (ignored): %r", e)
+
 
-    # set webhook
-    if not PUBLIC_BASE_URL:
+async def _set_webhook(tg_app: Application) -> None:
+    if not CFG.public_base_url:
         log.warning("Skipping setWebhook: PUBLIC_BASE_URL missing")
         return
 
-    webhook_path = f"/webhook/{WEBHOOK_SECRET}" if WEBHOOK_SECRET else "/webhook/no-secret"
-    webhook_url = f"{PUBLIC_BASE_URL}{webhook_path}"
+    webhook_url = f"{CFG.public_base_url}{WEBHOOK_PATH}"
 
     try:
+        # Ставим на каждом старте: секрет живёт в заголовке, а не в URL, и getWebhookInfo его
+        # не показывает — пропуск «URL тот же» после смены WEBHOOK_SECRET оставил бы Telegram
+        # со старым секретом (все апдейты -> 403). Pending updates не сбрасываем: при
+        # WEB_CONCURRENCY > 1 setWebhook зовёт каждый воркер, и апдейты не должны теряться
         await tg_app.bot.set_webhook(
             url=webhook_url,
-            secret_token=(WEBHOOK_SECRET if WEBHOOK_SECRET else None),
-            drop_pending_updates=True,
+            secret_token=(CFG.webhook_secret if CFG.webhook_secret else None),
         )
-        log.info(f"Webhook set to: {webhook_url}")
+        log.info("Webhook set to: %s (secret_token: %s)", webhook_url, _mask(CFG.webhook_secret) or "none")
     except Exception:
         log.exception("Failed to set webhook")
 
 
-@app.on_event("shutdown")
 async def on_shutdown() -> None:
-    global tg_app
-    if tg_app is None:
-        return
-    try:
-        await tg_app.stop()
-        await tg_app.shutdown()
-    except Exception:
-        log.exception("Shutdown error")
+    # новые апдейты больше не принимаем (503), уже принятые — дорабатываем, потом гасим воркеры
+    queue: "Optional[asyncio.Queue[Update]]" = app.state.update_queue
+    if queue is not None:
+        app.state.update_queue = None
+        try:
+            await asyncio.wait_for(queue.join(), CFG.shutdown_drain_timeout)
+        except TimeoutError:
+            # /summary может идти минутами (3 попытки x SMAIPL_TIMEOUT) — ждать его дольше kill_timeout бессмысленно
+            log.warning(
+                "shutdown_drain_timeout after=%.1fs dropped_queued=%d (in-flight updates are cancelled)",
+                CFG.shutdown_drain_timeout,
+                queue.qsize(),
+            )
+    workers = app.state.update_workers
+    app.state.update_workers = []
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    tg_app: Optional[Application] = app.state.tg_app
+    if tg_app is not None:
+        try:
+            if tg_app.updater is not None and tg_app.updater.running:
+                await tg_app.updater.stop()
+            await tg_app.stop()
+            await tg_app.shutdown()
+        except Exception:
+            log.exception("Shutdown error")
+
+    client: Optional[httpx.AsyncClient] = app.state.smaipl_client
+    if client is not None:
+        app.state.smaipl_client = None
+        await client.aclose()
 
 
 # ============================
@@ -422,4 +1010,14 @@ async def on_shutdown() -> None:
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # "auto" = uvloop + httptools, если установлены (requirements), иначе asyncio + h11 (например, Windows)
+    # несколько воркеров -> uvicorn нужен import string, а не объект app
+    uvicorn.run(
+        "worker:app",
+        host="0.0.0.0",
+        port=port,
+        workers=CFG.web_concurrency,
+        loop="auto",
+        http="auto",
+        access_log=False,
+    )